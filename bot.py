@@ -1,20 +1,57 @@
 import os
 import logging
+import random
 import json
 import re
-import base64
+import hashlib
+import io
+import math
 import asyncio
-from datetime import datetime
+import bisect
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from functools import partial
 from typing import Dict, List, Optional
 import traceback
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
-from telegram.ext import ConversationHandler
+from telegram.ext import ConversationHandler, AIORateLimiter
+from telegram.helpers import escape_markdown
 
 import gspread
+import httpx
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, RequestException
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# orjson parses several times faster than the stdlib; its JSONDecodeError
+# subclasses json.JSONDecodeError, so existing except clauses still apply
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# pybase64 encodes with SIMD instructions, several times faster than the stdlib
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
+# Pillow shrinks receipt photos before upload; without it photos are sent as-is
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from diagnostics import diagnose
 
 # Enable logging
 logging.basicConfig(
@@ -26,22 +63,291 @@ logger = logging.getLogger(__name__)
 # Conversation states
 CONFIRM_DETAILS, NAME, AMOUNT, DATE, CATEGORY, DESCRIPTION = range(6)
 
+# Only these update types have handlers, so Telegram needn't send anything else
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# Times a Telegram request is retried after a RetryAfter (429); AIORateLimiter
+# defaults to 0 and would hand the error straight back to the handler
+TELEGRAM_MAX_RETRIES = 3
+
+# Batched sheet writes: the writer coalesces up to FLUSH_BATCH_SIZE rows
+# arriving within FLUSH_DELAY seconds into a single append_rows call
+FLUSH_BATCH_SIZE = 50
+FLUSH_DELAY = 1.0
+# Seconds to wait for queued rows to be written when the bot stops
+FLUSH_TIMEOUT = 30
+
+# Sheet writes that fail with a quota error (429), a server error (5xx) or a
+# connection that was never made are retried with exponential backoff plus jitter,
+# waiting RETRY_BASE_DELAY * 2**attempt seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+# Attempts made at one batch before it is dropped, so a bad batch can't block the writer
+WRITE_MAX_ATTEMPTS = 5
+# Retries the OpenAI SDK makes, with its own backoff, on 429s, 5xx and timeouts
+OPENAI_MAX_RETRIES = 4
+# Seconds before a single OpenAI request is abandoned (and retried)
+OPENAI_TIMEOUT = 60.0
+# Receipt analyses allowed in flight at once; the rest wait their turn instead of
+# all hitting the API together and tripping its rate limit
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', '8'))
+# Seconds an idle OpenAI connection is kept open. httpx's default of 5s closes it
+# between receipts, so nearly every analysis paid for a fresh TLS handshake.
+OPENAI_KEEPALIVE = 120.0
+
+# Vision model used for receipts; it must support structured outputs. Bump
+# PROMPT_VERSION whenever the prompt or schema changes so cached analyses are not reused
+VISION_MODEL = os.getenv('VISION_MODEL', 'gpt-4o-mini')
+PROMPT_VERSION = 'v2'
+
+# Instructions sent with every receipt image
+RECEIPT_PROMPT = """Analyze this receipt image and extract the following information in JSON format:
+{
+    "store_name": "Name of the store/business",
+    "total_amount": 0.00,
+    "date": "Date on receipt in YYYY-MM-DD format if available",
+    "items": [
+        {"name": "item name", "price": 0.00, "quantity": 1}
+    ],
+    "currency": "Currency code like USD, EUR, etc",
+    "tax_amount": 0.00,
+    "payment_method": "Credit card, cash, etc if visible",
+    "summary": "Brief summary of the receipt"
+}
+
+Rules:
+1. Return ONLY valid JSON, no other text
+2. If information is not available, use null or empty string
+3. Convert all amounts to numbers (not strings)
+4. Date should be in YYYY-MM-DD format if possible
+5. Total amount is the final amount paid
+6. Store name should be the business name, not address
+7. Include a brief summary of what was purchased"""
+
+# Structured output schema for receipt analysis. Strict mode makes the model return
+# exactly this object, so the reply needs no extraction; missing values come back null.
+_NULLABLE_STRING = {"type": ["string", "null"]}
+_NULLABLE_NUMBER = {"type": ["number", "null"]}
+RECEIPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "store_name": _NULLABLE_STRING,
+        "total_amount": _NULLABLE_NUMBER,
+        "date": _NULLABLE_STRING,
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "price": _NULLABLE_NUMBER,
+                    "quantity": _NULLABLE_NUMBER
+                },
+                "required": ["name", "price", "quantity"],
+                "additionalProperties": False
+            }
+        },
+        "currency": _NULLABLE_STRING,
+        "tax_amount": _NULLABLE_NUMBER,
+        "payment_method": _NULLABLE_STRING,
+        "summary": _NULLABLE_STRING
+    },
+    "required": [
+        "store_name", "total_amount", "date", "items",
+        "currency", "tax_amount", "payment_method", "summary"
+    ],
+    "additionalProperties": False
+}
+RECEIPT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "receipt", "schema": RECEIPT_SCHEMA, "strict": True}
+}
+
+# Receipt photos are downscaled to this long edge and re-encoded before upload;
+# the model downsamples larger images itself, so the extra pixels only cost time
+IMAGE_MAX_SIDE = 1024
+IMAGE_JPEG_QUALITY = 80
+
+# Successful receipt analyses kept per image digest, so a resent photo costs no API call:
+# the most recent ones in memory, all of them as JSON files under RECEIPT_CACHE_DIR
+ANALYSIS_CACHE_SIZE = 128
+RECEIPT_CACHE_DIR = os.getenv('RECEIPT_CACHE_DIR', '.receipt_cache')
+
+# Worker threads for blocking gspread HTTP calls
+SHEETS_MAX_WORKERS = 4
+
+# Longest message we send; Telegram rejects anything over 4096 characters
+MESSAGE_CHUNK_SIZE = 4000
+# Longest text field (Date, Category, Store, Items, Note) shown per transaction in
+# /search, and longest name in its heading. Fields are cut before Markdown escaping,
+# which can double them, so five escaped fields at the cap still fit in one message.
+SEARCH_FIELD_MAX_LEN = 300
+
+# Seconds a downloaded copy of the sheet is reused for /search and /list.
+# Raise it when the bot is the only writer; lower it if people also edit the sheet by hand.
+RECORDS_CACHE_TTL = float(os.getenv('RECORDS_CACHE_TTL', '30'))
+
+# Check the sheet's header row at startup, writing it if missing. Set INIT_HEADERS=0
+# once the sheet is set up to skip the round-trip and assume the default columns.
+INIT_HEADERS = os.getenv('INIT_HEADERS', '1') != '0'
+
+# Sheet ranges: the header row, the Name..Image Available data rows /search
+# displays, and the Name column that is all /list needs
+HEADER_RANGE = 'A1:K1'
+RECORDS_RANGE = 'C2:K'
+NAMES_RANGE = 'C2:C'
+
+SHEET_HEADERS = [
+    'Timestamp', 'User ID', 'Name', 'Amount', 
+    'Date', 'Category', 'Description', 'Store',
+    'Items Summary', 'AI Analysis', 'Image Available'
+]
+# Transaction fields copied as-is into the Date..Store columns
+ROW_TEXT_KEYS = ('date', 'category', 'description', 'store')
+# RECORDS_RANGE starts at column C; positions below are within a cached row
+RECORDS_START_COL = 2
+RECORD_HEADERS = SHEET_HEADERS[RECORDS_START_COL:]
+NAME_COL = 0
+AMOUNT_COL = 1
+
+# Category picker shown after the date step; built once since it never changes
+CATEGORIES = [
+    ('Food', '🍔'), ('Transport', '🚗'), ('Shopping', '🛍️'), ('Entertainment', '🎬'),
+    ('Utilities', '💡'), ('Medical', '🏥'), ('Other', '❓')
+]
+CATEGORY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{name} {emoji}", callback_data=name)] for name, emoji in CATEGORIES
+])
+
+# Names per /list page; page buttons carry callback data "names:page:<n>"
+PAGE_SIZE = 20
+NAMES_PAGE_RE = r'^names:page:\d+$'
+
+# Separator between transactions in /search results
+DIVIDER = '─' * 30 + '\n'
+
+# Characters dropped from a typed amount ("$1,250.00" -> "1250.00") in one pass
+AMOUNT_STRIP = str.maketrans({'$': None, ',': None, ' ': None})
+TODAY_RE = re.compile(r'^\s*today\s*$', re.IGNORECASE)
+
+WELCOME_TEXT = """
+👋 Hello {first_name}!
+
+Welcome to AI Receipt Scanner Bot! 🤖📸
+
+I use AI to analyze receipt photos and save them to Google Sheets.
+
+**How to use:**
+1. Send me a photo of any receipt
+2. I'll analyze it with AI
+3. Review the analysis
+4. Confirm details
+5. Select category
+6. ✅ Saved to Google Sheets!
+
+**Commands:**
+/add - Add transaction manually
+/search <name> - Find transactions
+/list - List all people
+/help - Show help
+
+Try sending me a receipt photo now! 📸
+"""
+
+HELP_TEXT = """
+🤖 **AI Receipt Scanner Bot Help**
+
+**Main Features:**
+📸 Send any receipt photo - AI analyzes it automatically!
+🤖 GPT-4 Vision extracts details with high accuracy
+📊 Saves to Google Sheets with rich data
+
+**Commands:**
+/start - Welcome message
+/add - Add transaction manually
+/search <name> - Find transactions by name
+/list - List all people
+/help - This message
+
+**How it works:**
+1. Send a receipt photo
+2. AI analyzes and extracts details
+3. Review AI findings
+4. Confirm to save
+5. Add person's name
+6. Select category
+7. Add description
+8. ✅ Saved to Google Sheets!
+
+**Example:**
+/search John Doe
+Shows all John's receipts
+"""
+
+def escape_md(value) -> str:
+    """Escape user or model text for parse_mode='Markdown' so a stray * or _ can't break the message"""
+    return escape_markdown(str(value))
+
+def clip_text(value, limit: int) -> str:
+    """Shorten text to at most limit characters, marking the cut with an ellipsis"""
+    text = str(value)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def parse_amount(value) -> float:
+    """Return a sheet Amount cell as a float, treating blanks and junk as 0"""
+    # Amounts are written as numbers and read back unformatted, so only
+    # rows typed in by hand need parsing
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+class SheetWriteError(Exception):
+    """Raised when queued rows could not be written to the sheet and were dropped"""
+
+class SheetWriteUncertain(SheetWriteError):
+    """Raised when an append failed after it was sent, so the rows may be on the sheet"""
+
 class AIVisionProcessor:
     """Handles receipt analysis using OpenAI GPT-4 Vision"""
     
-    def __init__(self, openai_api_key: str = None):
+    def __init__(self, openai_api_key: str = None, cache_dir: str = RECEIPT_CACHE_DIR):
         self.openai_client = None
         
         if openai_api_key:
             try:
-                # Simplified OpenAI client initialization
-                self.openai_client = OpenAI(api_key=openai_api_key)
+                # Async client: requests run on the event loop, no thread per analysis
+                self.openai_client = AsyncOpenAI(
+                    api_key=openai_api_key,
+                    max_retries=OPENAI_MAX_RETRIES,
+                    timeout=OPENAI_TIMEOUT,
+                    # One warm connection per concurrent analysis
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=OPENAI_CONCURRENCY,
+                            max_keepalive_connections=OPENAI_CONCURRENCY,
+                            keepalive_expiry=OPENAI_KEEPALIVE
+                        )
+                    )
+                )
                 logger.info("✅ OpenAI GPT-4 Vision initialized")
             except Exception as e:
-                logger.warning(f"OpenAI initialization failed: {e}")
+                logger.warning("OpenAI initialization failed: %s", e)
                 traceback.print_exc()
         else:
             logger.warning("No OpenAI API key provided")
+        
+        self._semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+        
+        # LRU of parsed results keyed by image digest; errors are never cached
+        self._analysis_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self.cache_dir = cache_dir
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning("Receipt cache dir unavailable, caching in memory only: %s", e)
+            self.cache_dir = None
     
     async def analyze_receipt_image(self, image_bytes: bytes) -> Dict[str, any]:
         """Analyze receipt image using GPT-4 Vision"""
@@ -49,121 +355,183 @@ class AIVisionProcessor:
             logger.warning("OpenAI client not available")
             return {"error": "OpenAI not configured"}
         
+        digest = self._image_key(image_bytes)
+        cached = self._get_cached_analysis(digest)
+        if cached is not None:
+            logger.info("✅ Reusing analysis of an identical receipt image")
+            return cached
+        
         try:
-            # Encode image to base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            # Prepare the prompt for receipt analysis
-            prompt = """Analyze this receipt image and extract the following information in JSON format:
-            {
-                "store_name": "Name of the store/business",
-                "total_amount": 0.00,
-                "date": "Date on receipt in YYYY-MM-DD format if available",
-                "items": [
-                    {"name": "item name", "price": 0.00, "quantity": 1}
-                ],
-                "currency": "Currency code like USD, EUR, etc",
-                "tax_amount": 0.00,
-                "payment_method": "Credit card, cash, etc if visible",
-                "summary": "Brief summary of the receipt"
-            }
-
-            Rules:
-            1. Return ONLY valid JSON, no other text
-            2. If information is not available, use null or empty string
-            3. Convert all amounts to numbers (not strings)
-            4. Date should be in YYYY-MM-DD format if possible
-            5. Total amount is the final amount paid
-            6. Store name should be the business name, not address
-            7. Include a brief summary of what was purchased"""
-            
-            # Call OpenAI API using asyncio.to_thread
-            response = await asyncio.to_thread(
-                self.openai_client.chat.completions.create,
-                model="gpt-4-vision-preview",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_b64}"
+            image_bytes = await asyncio.to_thread(self._shrink_image, image_bytes)
+            
+            # Build the data URL in one expression so the intermediate base64 copies are
+            # freed right away and only the URL lives through the API call. The output is
+            # pure ASCII, so skip UTF-8 validation.
+            image_url = "data:image/jpeg;base64," + b64encode(image_bytes).decode('ascii')
+            del image_bytes
+            
+            # Call OpenAI API
+            async with self._semaphore:
+                response = await self.openai_client.chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": RECEIPT_PROMPT},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": image_url
+                                    }
                                 }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000
-            )
+                            ]
+                        }
+                    ],
+                    response_format=RECEIPT_RESPONSE_FORMAT,
+                    max_tokens=1000
+                )
             
-            # Extract and parse JSON response
-            content = response.choices[0].message.content
-            logger.info(f"OpenAI Response: {content[:200]}...")
+            message = response.choices[0].message
+            if message.refusal:
+                logger.error("Receipt analysis refused: %s", message.refusal)
+                return {"error": "The receipt could not be analyzed"}
             
-            # Extract JSON from response (in case there's additional text)
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                try:
-                    receipt_data = json.loads(json_str)
-                    logger.info(f"✅ Successfully parsed receipt data")
-                    return receipt_data
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse JSON: {e}")
-                    return {"error": f"JSON parse error: {e}", "raw_response": content}
-            else:
-                logger.error("No JSON found in response")
-                return {"error": "No JSON in response", "raw_response": content}
+            content = message.content
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("OpenAI Response: %s...", content[:200])
+            
+            # The reply is the schema object itself; it only fails to parse
+            # when it was cut off at max_tokens
+            try:
+                receipt_data = json_loads(content)
+            except json.JSONDecodeError as e:
+                logger.error("Failed to parse JSON: %s; response: %.500s", e, content)
+                return {"error": f"JSON parse error: {e}"}
+            
+            logger.info("✅ Successfully parsed receipt data")
+            self._store_analysis(digest, receipt_data)
+            return receipt_data
                 
         except Exception as e:
-            logger.error(f"OpenAI Vision error: {e}")
+            logger.error("OpenAI Vision error: %s", e)
             traceback.print_exc()
             return {"error": str(e)}
     
+    async def close(self):
+        """Close the pooled OpenAI connections"""
+        if self.openai_client:
+            await self.openai_client.close()
+    
+    @staticmethod
+    def _shrink_image(image_bytes: bytes) -> bytes:
+        """Downscale and recompress a photo for upload, keeping the original if that's smaller"""
+        if Image is None:
+            return image_bytes
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                if img.format == 'JPEG' and max(img.size) <= IMAGE_MAX_SIDE:
+                    return image_bytes
+                img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+                buf = io.BytesIO()
+                img.convert('RGB').save(buf, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        except Exception as e:
+            logger.warning("Could not shrink receipt image, sending original: %s", e)
+            return image_bytes
+        shrunk = buf.getvalue()
+        return shrunk if len(shrunk) < len(image_bytes) else image_bytes
+    
+    @staticmethod
+    def _image_key(image_bytes: bytes) -> str:
+        """Cache key for an image under the current model and prompt"""
+        h = hashlib.blake2b(f"{VISION_MODEL}:{PROMPT_VERSION}:".encode(), digest_size=16)
+        h.update(image_bytes)
+        return h.hexdigest()
+    
+    def _get_cached_analysis(self, key: str) -> Optional[Dict]:
+        """Look up a previous analysis in memory, then on disk"""
+        receipt_data = self._analysis_cache.get(key)
+        if receipt_data is not None:
+            self._analysis_cache.move_to_end(key)
+            return receipt_data
+        if not self.cache_dir:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.json"), 'rb') as f:
+                receipt_data = json_loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable receipt cache entry %s: %s", key, e)
+            return None
+        self._remember(key, receipt_data)
+        return receipt_data
+    
+    def _store_analysis(self, key: str, receipt_data: Dict):
+        """Save a successful analysis in memory and on disk"""
+        self._remember(key, receipt_data)
+        if not self.cache_dir:
+            return
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(receipt_data, f)
+            # Atomic rename so a concurrent reader never sees a half-written file
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Failed to cache receipt analysis: %s", e)
+    
+    def _remember(self, key: str, receipt_data: Dict):
+        """Add an analysis to the in-memory LRU"""
+        self._analysis_cache[key] = receipt_data
+        self._analysis_cache.move_to_end(key)
+        if len(self._analysis_cache) > ANALYSIS_CACHE_SIZE:
+            self._analysis_cache.popitem(last=False)
+    
     def format_receipt_for_display(self, receipt_data: Dict) -> str:
         """Format receipt data for user display"""
         if "error" in receipt_data:
-            return f"❌ Error analyzing receipt: {receipt_data['error']}"
+            return f"❌ Error analyzing receipt: {escape_md(receipt_data['error'])}"
         
-        response = "📋 **Receipt Analysis Results:**\n\n"
+        parts = ["📋 **Receipt Analysis Results:**\n\n"]
         
         if receipt_data.get('store_name'):
-            response += f"🏪 **Store:** {receipt_data['store_name']}\n"
+            parts.append(f"🏪 **Store:** {escape_md(receipt_data['store_name'])}\n")
         
+        # Schema fields the model couldn't read come back as null
         if receipt_data.get('total_amount'):
-            currency = receipt_data.get('currency', 'USD')
-            response += f"💰 **Total:** {currency} {receipt_data['total_amount']:.2f}\n"
+            currency = escape_md(receipt_data.get('currency') or 'USD')
+            parts.append(f"💰 **Total:** {currency} {receipt_data['total_amount']:.2f}\n")
         
         if receipt_data.get('date'):
-            response += f"📅 **Date:** {receipt_data['date']}\n"
+            parts.append(f"📅 **Date:** {escape_md(receipt_data['date'])}\n")
         
         if receipt_data.get('tax_amount'):
-            response += f"🧾 **Tax:** {receipt_data.get('tax_amount', 0):.2f}\n"
+            parts.append(f"🧾 **Tax:** {receipt_data['tax_amount']:.2f}\n")
         
         if receipt_data.get('payment_method'):
-            response += f"💳 **Payment:** {receipt_data['payment_method']}\n"
+            parts.append(f"💳 **Payment:** {escape_md(receipt_data['payment_method'])}\n")
         
         # Show items
-        items = receipt_data.get('items', [])
+        items = receipt_data.get('items') or []
         if items:
-            response += "\n🛒 **Items:**\n"
+            parts.append("\n🛒 **Items:**\n")
             for i, item in enumerate(items[:5], 1):  # Show first 5 items
-                name = item.get('name', 'Unknown')
-                price = item.get('price', 0)
-                quantity = item.get('quantity', 1)
-                response += f"  {i}. {name}"
+                name = escape_md(item.get('name') or 'Unknown')
+                price = item.get('price') or 0
+                quantity = item.get('quantity') or 1
+                parts.append(f"  {i}. {name}")
                 if quantity > 1:
-                    response += f" (x{quantity})"
-                response += f" - ${price:.2f}\n"
+                    parts.append(f" (x{quantity:g})")
+                parts.append(f" - ${price:.2f}\n")
             if len(items) > 5:
-                response += f"  ... and {len(items) - 5} more items\n"
+                parts.append(f"  ... and {len(items) - 5} more items\n")
         
         if receipt_data.get('summary'):
-            response += f"\n📝 **Summary:** {receipt_data['summary']}\n"
+            parts.append(f"\n📝 **Summary:** {escape_md(receipt_data['summary'])}\n")
         
-        return response
+        return "".join(parts)
 
 class GoogleSheetManager:
     def __init__(self):
@@ -181,10 +549,10 @@ class GoogleSheetManager:
         
         try:
             # Parse credentials
-            creds_dict = json.loads(creds_json)
-            logger.info(f"Service account: {creds_dict.get('client_email')}")
+            creds_dict = json_loads(creds_json)
+            logger.info("Service account: %s", creds_dict.get('client_email'))
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON: {e}")
+            logger.error("Invalid JSON: %s", e)
             raise
         
         SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
@@ -192,7 +560,7 @@ class GoogleSheetManager:
         
         try:
             creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-            self.client = gspread.authorize(creds)
+            self.client = gspread.Client(auth=creds, session=self._build_session(creds))
             logger.info("✅ Google Sheets authorized")
             
             # Open the sheet
@@ -202,28 +570,97 @@ class GoogleSheetManager:
                 # If it's just a sheet ID
                 self.sheet = self.client.open_by_key(sheet_url).sheet1
             
-            logger.info(f"✅ Sheet opened: {self.sheet.title}")
+            logger.info("✅ Sheet opened: %s", self.sheet.title)
             
         except Exception as e:
-            logger.error(f"Failed to open sheet: {e}")
+            logger.error("Failed to open sheet: %s", e)
             traceback.print_exc()
             raise
         
-        # Initialize headers if needed
-        try:
-            if not self.sheet.get_all_values():
-                headers = [
-                    'Timestamp', 'User ID', 'Name', 'Amount', 
-                    'Date', 'Category', 'Description', 'Store',
-                    'Items Summary', 'AI Analysis', 'Image Available'
-                ]
-                self.sheet.append_row(headers)
-                logger.info("📝 Initialized sheet headers")
-        except Exception as e:
-            logger.error(f"Failed to init headers: {e}")
+        # Initialize headers if needed; only the header row is fetched, not the whole sheet.
+        # The row is kept so record reads can skip it.
+        header_row = SHEET_HEADERS
+        if INIT_HEADERS:
+            try:
+                first_row = self.sheet.get(HEADER_RANGE)
+                if not first_row or not first_row[0]:
+                    # A ranged write lands exactly on row 1, with no table detection
+                    self.sheet.update(
+                        values=[SHEET_HEADERS],
+                        range_name=HEADER_RANGE,
+                        value_input_option='RAW'
+                    )
+                    logger.info("📝 Initialized sheet headers")
+                else:
+                    header_row = first_row[0]
+            except Exception as e:
+                logger.error("Failed to init headers: %s", e)
+        
+        # Blocking gspread calls run here so they don't stall the event loop
+        self._executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS)
+        
+        # Single-writer queue: all sheet appends go through _writer_loop in order.
+        # _pending mirrors the rows that are queued or in flight, and _saves holds
+        # one future per pending row that the writer resolves to None once the row
+        # is written, or to the error that made it drop the row.
+        self._write_queue: asyncio.Queue = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task] = None
+        self._pending: List[list] = []
+        self._saves: List[asyncio.Future] = []
+        # Running counts of rows ever queued and batches ever dropped, so a refresh can
+        # tell what changed in _pending while it was indexing outside the lock
+        self._queued_total = 0
+        self._drop_count = 0
+        
+        # Compact local copy of RECORDS_RANGE, refreshed after RECORDS_CACHE_TTL
+        # seconds: one shared header plus plain row lists. Dicts are only built
+        # for the rows a /search actually returns.
+        self._header: List[str] = list(header_row[RECORDS_START_COL:])
+        self._header += RECORD_HEADERS[len(self._header):]
+        self._rows: Optional[List[list]] = None
+        self._cache_ts: float = 0
+        # Indexes over the cached rows: case-folded name -> rows, display names,
+        # and case-folded name -> running total of Amount
+        self._by_name: Dict[str, List[list]] = defaultdict(list)
+        self._names_set: set = set()
+        self._totals: Dict[str, float] = {}
+        # Sorted copy of _names_set for /list; sorted once per refresh, then new
+        # names are inserted in place
+        self._sorted_names: Optional[List[str]] = None
+        # Handlers update the cache on the event loop while refreshes and lookups run
+        # on executor threads; this guards _pending, the rows and all the indexes
+        self._cache_lock = threading.Lock()
+        # Held for the duration of a sheet download so only one runs at a time
+        self._refresh_lock = threading.Lock()
+        # Held across an append and the removal of its rows from _pending, and across
+        # a download and the merge of _pending into it. A download therefore never
+        # overlaps an append, and every row is either on the sheet or in _pending,
+        # never both or neither.
+        self._sheet_lock = threading.Lock()
     
-    def add_transaction(self, data: Dict):
-        """Add a new transaction to the sheet"""
+    @staticmethod
+    def _build_session(creds) -> AuthorizedSession:
+        """Create one pooled keep-alive HTTP session shared by every Sheets call"""
+        session = AuthorizedSession(creds)
+        # Only idempotent requests are retried by urllib3, so appends are never duplicated;
+        # raise_on_status=False lets gspread turn the final response into an APIError
+        retries = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+        # One keep-alive connection per executor thread; every call goes to the same host
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=SHEETS_MAX_WORKERS,
+            max_retries=retries
+        )
+        session.mount('https://', adapter)
+        return session
+    
+    async def add_transaction(self, data: Dict) -> asyncio.Future:
+        """Queue a new transaction for the next batched write, returning a future for its result"""
         # Format items summary
         items_summary = ""
         if data.get('items'):
@@ -234,51 +671,293 @@ class GoogleSheetManager:
                 if len(items) > 3:
                     items_summary += f" and {len(items)-3} more"
         
+        # The timestamp is captured now and formatted by the writer just before the flush
         row = [
-            datetime.now().isoformat(),
+            time.time(),
             data.get('user_id', ''),
             data.get('name', ''),
-            data.get('amount', 0),
-            data.get('date', ''),
-            data.get('category', ''),
-            data.get('description', ''),
-            data.get('store', ''),
+            float(data.get('amount') or 0),
+            *(data.get(key, '') for key in ROW_TEXT_KEYS),
             items_summary,
             data.get('ai_analysis', 'No'),
             'Yes' if data.get('has_image') else 'No'
         ]
-        self.sheet.append_row(row)
-        logger.info(f"Added: {data.get('name')} - ${data.get('amount')}")
-        return True
+        with self._cache_lock:
+            self._pending.append(row)
+            self._queued_total += 1
+            # Write through to the cached rows and indexes so readers never refetch
+            if self._rows is not None:
+                record = row[RECORDS_START_COL:]
+                name = str(record[NAME_COL]).strip()
+                if name and name not in self._names_set and self._sorted_names is not None:
+                    bisect.insort(self._sorted_names, name)
+                self._rows.append(record)
+                self._index_record(record, self._by_name, self._names_set, self._totals)
+        
+        # Resolved by the writer to None once the row is written, or to the error it was dropped for
+        saved = asyncio.get_running_loop().create_future()
+        self._saves.append(saved)
+        self._ensure_writer()
+        await self._write_queue.put(row)
+        logger.info("Queued: %s - $%s", data.get('name'), data.get('amount'))
+        return saved
     
-    def get_transactions_by_name(self, name: str) -> List[Dict]:
+    def _ensure_writer(self):
+        """Start the background writer task if it is not running"""
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._writer_loop())
+    
+    async def _writer_loop(self):
+        """Drain the write queue, coalescing rows into one append_rows call per batch"""
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._write_queue.get()]
+            deadline = loop.time() + FLUSH_DELAY
+            while len(rows) < FLUSH_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(self._write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            fromtimestamp = datetime.fromtimestamp
+            for row in rows:
+                row[0] = fromtimestamp(row[0], timezone.utc).isoformat(timespec='seconds')
+            errors = await self._write_rows(rows)
+            saves, self._saves[:len(rows)] = self._saves[:len(rows)], []
+            for saved, error in zip(saves, errors):
+                saved.set_result(error)
+    
+    async def _write_rows(self, rows: List[list]) -> List[Optional[SheetWriteError]]:
+        """Append a batch of rows, returning None for each row written or the error it was dropped for"""
+        attempt = 0
+        while True:
+            try:
+                await self._run_blocking(self._append_rows_sync, rows)
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt < WRITE_MAX_ATTEMPTS and self._is_retryable(e):
+                    # Back off so a quota error (429) isn't hammered with more requests
+                    delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY) + random.random()
+                    logger.error("Failed to write %s rows, retrying in %.1fs: %s", len(rows), delay, e)
+                    await asyncio.sleep(delay)
+                    continue
+                if len(rows) > 1 and self._is_rejected(e):
+                    # One bad row gets the whole batch rejected; write the rows one at a
+                    # time so only that row is lost, not the other chats' saves with it
+                    logger.warning("Sheets rejected a batch of %s rows, writing them one by one: %s",
+                                   len(rows), e)
+                    errors = []
+                    for row in rows:
+                        errors += await self._write_rows([row])
+                    return errors
+                return self._drop_rows(rows, e, attempt)
+        logger.info("Flushed %s rows to sheet", len(rows))
+        return [None] * len(rows)
+    
+    def _drop_rows(self, rows: List[list], error: Exception, attempts: int) -> List[SheetWriteError]:
+        """Give up on a batch, returning one error per row for the callers waiting on it"""
+        # A request that failed after it was sent (a read timeout, a dropped connection)
+        # may still have been stored, so it is never retried and is reported as uncertain
+        uncertain = isinstance(error, RequestException) and not self._never_sent(error)
+        # Log the rows so they can be checked and re-entered by hand, then move on so
+        # later batches aren't stuck behind this one
+        logger.error("Dropping %s rows after %s attempts%s: %s\n%s", len(rows), attempts,
+                     " (they may already be on the sheet)" if uncertain else "", error, rows)
+        with self._cache_lock:
+            del self._pending[:len(rows)]
+            self._drop_count += 1
+            # The rows were written through to the cache; refetch so /search and the
+            # totals show what the sheet really holds
+            self._cache_ts = 0
+        kind = SheetWriteUncertain if uncertain else SheetWriteError
+        errors = []
+        for _ in rows:
+            dropped = kind(f"Row could not be saved: {error}")
+            dropped.__cause__ = error
+            errors.append(dropped)
+        return errors
+    
+    def _append_rows_sync(self, rows: List[list]):
+        """Append rows to the sheet and stop counting them as pending, as one step"""
+        with self._sheet_lock:
+            self.sheet.append_rows(
+                rows,
+                value_input_option='RAW',
+                insert_data_option='INSERT_ROWS'
+            )
+            with self._cache_lock:
+                del self._pending[:len(rows)]
+    
+    @staticmethod
+    def _never_sent(error: Exception) -> bool:
+        """Whether a failed request certainly never reached Google"""
+        if isinstance(error, ConnectTimeout):
+            return True
+        # A refused or unresolvable connection arrives as ConnectionError(MaxRetryError);
+        # one dropped mid-request wraps a ProtocolError instead and is ambiguous
+        if isinstance(error, RequestsConnectionError) and error.args:
+            return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+        return False
+    
+    @classmethod
+    def _is_retryable(cls, error: Exception) -> bool:
+        """Whether a failed append can be sent again without risking a duplicate"""
+        # append_rows is a POST, so only failures where Sheets stored nothing are safe
+        if isinstance(error, gspread.exceptions.APIError):
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        return cls._never_sent(error)
+    
+    @staticmethod
+    def _is_rejected(error: Exception) -> bool:
+        """Whether Sheets refused the request itself (a 4xx other than 429)"""
+        if isinstance(error, gspread.exceptions.APIError):
+            status = error.response.status_code
+            return 400 <= status < 500 and status != 429
+        return False
+    
+    async def flush(self):
+        """Wait for every queued row on shutdown, raising SheetWriteError if any were dropped"""
+        if not self._saves:
+            return
+        self._ensure_writer()
+        # asyncio.wait leaves the futures alone if the caller times out
+        done, _ = await asyncio.wait(list(self._saves))
+        errors = [saved.result() for saved in done if saved.result() is not None]
+        if errors:
+            raise SheetWriteError(f"{len(errors)} rows could not be saved") from errors[0]
+    
+    async def _run_blocking(self, func, *args, **kwargs):
+        """Run a blocking gspread call on the sheets thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    def _cache_fresh(self, ttl: float = RECORDS_CACHE_TTL) -> bool:
+        """Check whether the cached records can still be used"""
+        return self._rows is not None and time.monotonic() - self._cache_ts < ttl
+    
+    def _fetch_rows(self) -> List[list]:
+        """Download RECORDS_RANGE, returning rows padded to the cached header's width"""
+        values = self.sheet.get(
+            RECORDS_RANGE,
+            value_render_option='UNFORMATTED_VALUE',
+            date_time_render_option='FORMATTED_STRING'
+        )
+        width = len(self._header)
+        rows = [row[:width] + [''] * (width - len(row)) for row in values]
+        # Type Amount once here so totals and /search never parse it again
+        for row in rows:
+            row[AMOUNT_COL] = parse_amount(row[AMOUNT_COL])
+        return rows
+    
+    def _get_records_cached(self, ttl: float = RECORDS_CACHE_TTL) -> List[list]:
+        """Return all cached rows, downloading them at most once per ttl seconds"""
+        if not self._cache_fresh(ttl):
+            # Single flight: concurrent refreshers queue here and, once the first
+            # download lands, find the cache fresh instead of fetching again
+            with self._refresh_lock:
+                if not self._cache_fresh(ttl):
+                    with self._sheet_lock:
+                        rows = self._fetch_rows()
+                        # Rows still waiting for a flush are not on the sheet yet. Only the
+                        # copy happens under the cache lock: add_transaction takes it on the
+                        # event loop, so indexing every row there would stall all chats.
+                        with self._cache_lock:
+                            rows.extend(row[RECORDS_START_COL:] for row in self._pending)
+                            queued, drops = self._queued_total, self._drop_count
+                    
+                    by_name: Dict[str, List[list]] = defaultdict(list)
+                    names = set()
+                    totals: Dict[str, float] = {}
+                    for row in rows:
+                        self._index_record(row, by_name, names, totals)
+                    
+                    with self._cache_lock:
+                        # Rows queued meanwhile were written through to the old indexes.
+                        # Writes and drops only ever remove the oldest pending rows, so
+                        # whichever of them are still pending sit at the tail.
+                        added = self._queued_total - queued
+                        for row in self._pending[max(0, len(self._pending) - added):]:
+                            record = row[RECORDS_START_COL:]
+                            rows.append(record)
+                            self._index_record(record, by_name, names, totals)
+                        self._rows = rows
+                        self._by_name, self._names_set, self._totals = by_name, names, totals
+                        self._sorted_names = None
+                        # A batch dropped meanwhile may have been copied in above; leave the
+                        # cache stale so the next read refetches without it
+                        self._cache_ts = time.monotonic() if self._drop_count == drops else 0
+        return self._rows
+    
+    @staticmethod
+    def _index_record(row: list, by_name: Dict[str, List[list]], names: set,
+                      totals: Dict[str, float]):
+        """Add a single cached row to the name indexes"""
+        name = str(row[NAME_COL]).strip()
+        if name:
+            key = name.casefold()
+            by_name[key].append(row)
+            names.add(name)
+            totals[key] = totals.get(key, 0.0) + row[AMOUNT_COL]
+    
+    async def get_transactions_by_name(self, name: str) -> List[Dict]:
+        """Get all transactions for a specific person"""
+        return await self._run_blocking(self._get_transactions_by_name_sync, name)
+    
+    async def get_all_names(self) -> List[str]:
+        """Get the sorted list of all unique names"""
+        return await self._run_blocking(self._get_all_names_sync)
+    
+    def get_total_by_name(self, name: str) -> float:
+        """Get the summed Amount for a person from the cached index"""
+        return self._totals.get(name.strip().casefold(), 0.0)
+    
+    def _get_transactions_by_name_sync(self, name: str) -> List[Dict]:
         """Get all transactions for a specific person"""
         try:
-            all_data = self.sheet.get_all_records()
-            transactions = []
-            
-            for row in all_data:
-                if str(row.get('Name', '')).lower() == name.lower():
-                    transactions.append(row)
+            key = name.strip().casefold()
+            if not self._cache_fresh():
+                # Check the Name column before downloading every row, so searching
+                # for an unknown name costs one column read
+                if not any(n.casefold() == key for n in self._get_all_names_sync()):
+                    logger.info("No transactions for %s", name)
+                    return []
             
-            logger.info(f"Found {len(transactions)} transactions for {name}")
+            self._get_records_cached()
+            header = self._header
+            with self._cache_lock:
+                transactions = [dict(zip(header, row)) for row in self._by_name.get(key, [])]
+            logger.info("Found %s transactions for %s", len(transactions), name)
             return transactions
         except Exception as e:
-            logger.error(f"Error getting transactions: {e}")
+            logger.error("Error getting transactions: %s", e)
             return []
     
-    def get_all_names(self) -> List[str]:
-        """Get list of all unique names"""
+    def _get_all_names_sync(self) -> List[str]:
+        """Get the sorted list of all unique names"""
         try:
-            all_data = self.sheet.get_all_records()
-            names = set()
-            for row in all_data:
-                name = str(row.get('Name', '')).strip()
-                if name:
-                    names.add(name)
-            return list(names)
+            if self._cache_fresh():
+                with self._cache_lock:
+                    if self._sorted_names is None:
+                        self._sorted_names = sorted(self._names_set)
+                    return self._sorted_names
+            
+            # Cold cache: the names column alone is enough for /list
+            with self._sheet_lock:
+                columns = self.sheet.get(NAMES_RANGE, major_dimension='COLUMNS')
+                names = {str(name).strip() for name in (columns[0] if columns else [])}
+                with self._cache_lock:
+                    names.update(
+                        str(row[RECORDS_START_COL + NAME_COL]).strip() for row in self._pending
+                    )
+            names.discard('')
+            return sorted(names)
         except Exception as e:
-            logger.error(f"Error getting names: {e}")
+            logger.error("Error getting names: %s", e)
             return []
 
 class ReceiptBot:
@@ -288,32 +967,8 @@ class ReceiptBot:
         
     async def start(self, update: Update, context: CallbackContext):
         """Send welcome message"""
-        user = update.effective_user
-        welcome_text = f"""
-👋 Hello {user.first_name}!
-
-Welcome to AI Receipt Scanner Bot! 🤖📸
-
-I use AI to analyze receipt photos and save them to Google Sheets.
-
-**How to use:**
-1. Send me a photo of any receipt
-2. I'll analyze it with AI
-3. Review the analysis
-4. Confirm details
-5. Select category
-6. ✅ Saved to Google Sheets!
-
-**Commands:**
-/add - Add transaction manually
-/search <name> - Find transactions
-/list - List all people
-/help - Show help
-
-Try sending me a receipt photo now! 📸
-        """
+        welcome_text = WELCOME_TEXT.format(first_name=escape_md(update.effective_user.first_name))
         await update.message.reply_text(welcome_text, parse_mode='Markdown')
-        return ConversationHandler.END
     
     async def handle_photo(self, update: Update, context: CallbackContext):
         """Handle receipt photo upload with AI analysis"""
@@ -322,15 +977,21 @@ Try sending me a receipt photo now! 📸
             photo_file = await update.message.photo[-1].get_file()
             photo_bytes = await photo_file.download_as_bytearray()
             
-            # Store in context
-            context.user_data['receipt_photo'] = photo_bytes
+            # Only the fact that there was a photo is kept; the bytes are dropped
+            # once analysed instead of living in user_data for the whole conversation
             context.user_data['has_image'] = True
             
-            # Start AI analysis
-            await update.message.reply_text("🤖 Analyzing receipt with AI...")
-            
-            # Analyze with OpenAI
-            receipt_data = await self.ai_vision.analyze_receipt_image(photo_bytes)
+            # Send the ack in the background and start the analysis right away rather
+            # than waiting for the ack's round-trip before calling OpenAI
+            ack = asyncio.create_task(update.message.reply_text("🤖 Analyzing receipt with AI..."))
+            try:
+                receipt_data = await self.ai_vision.analyze_receipt_image(photo_bytes)
+            finally:
+                # A lost ack is cosmetic; it must not throw away the analysis
+                try:
+                    await ack
+                except Exception as e:
+                    logger.warning("Failed to send analysis notice: %s", e)
             
             # Store analysis results
             context.user_data['ai_analysis'] = receipt_data
@@ -345,15 +1006,14 @@ Try sending me a receipt photo now! 📸
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            response = analysis_display + "\n\n"
-            response += "Would you like to save this to Google Sheets?"
+            response = analysis_display + "\n\nWould you like to save this to Google Sheets?"
             
             await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
             
             return CONFIRM_DETAILS
             
         except Exception as e:
-            logger.error(f"Error processing photo: {e}")
+            logger.error("Error processing photo: %s", e)
             traceback.print_exc()
             await update.message.reply_text(
                 "❌ Error analyzing receipt photo.\n"
@@ -403,7 +1063,7 @@ Try sending me a receipt photo now! 📸
         total_amount = receipt_data.get('total_amount')
         
         if total_amount and 'error' not in receipt_data:
-            currency = receipt_data.get('currency', 'USD')
+            currency = receipt_data.get('currency') or 'USD'
             await update.message.reply_text(
                 f"💰 AI detected total: {currency} {total_amount:.2f}\n"
                 "Press Enter to accept, or enter a different amount:"
@@ -426,7 +1086,10 @@ Try sending me a receipt photo now! 📸
             amount = detected_amount
         else:
             try:
-                amount = float(user_input.replace('$', '').replace(',', '').strip())
+                amount = float(user_input.translate(AMOUNT_STRIP))
+                # float() also accepts 'nan' and 'inf', which would poison the totals
+                if not math.isfinite(amount):
+                    raise ValueError(user_input)
             except ValueError:
                 await update.message.reply_text("❌ Invalid amount. Please enter a number (e.g., 25.50):")
                 return AMOUNT
@@ -457,8 +1120,8 @@ Try sending me a receipt photo now! 📸
         # If user pressed Enter and we have detected date, use it
         if user_input == '' and detected_date and 'error' not in receipt_data:
             date_text = detected_date
-        elif user_input.lower() == 'today':
-            date_text = datetime.now().strftime('%Y-%m-%d')
+        elif TODAY_RE.match(user_input):
+            date_text = date.today().isoformat()
         else:
             date_text = user_input
         
@@ -483,20 +1146,9 @@ Try sending me a receipt photo now! 📸
             context.user_data['items'] = items
         
         # Show categories
-        keyboard = [
-            [InlineKeyboardButton("Food 🍔", callback_data="Food")],
-            [InlineKeyboardButton("Transport 🚗", callback_data="Transport")],
-            [InlineKeyboardButton("Shopping 🛍️", callback_data="Shopping")],
-            [InlineKeyboardButton("Entertainment 🎬", callback_data="Entertainment")],
-            [InlineKeyboardButton("Utilities 💡", callback_data="Utilities")],
-            [InlineKeyboardButton("Medical 🏥", callback_data="Medical")],
-            [InlineKeyboardButton("Other ❓", callback_data="Other")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             "Select a category:",
-            reply_markup=reply_markup
+            reply_markup=CATEGORY_MARKUP
         )
         return CATEGORY
     
@@ -509,23 +1161,25 @@ Try sending me a receipt photo now! 📸
         context.user_data['category'] = category
         
         # Prepare summary of what will be saved
-        summary = "📋 **Final Review:**\n\n"
-        summary += f"👤 Name: {context.user_data.get('name')}\n"
-        summary += f"💰 Amount: ${context.user_data.get('amount', 0):.2f}\n"
-        summary += f"📅 Date: {context.user_data.get('date')}\n"
+        parts = [
+            "📋 **Final Review:**\n\n"
+            f"👤 Name: {escape_md(context.user_data.get('name'))}\n"
+            f"💰 Amount: ${context.user_data.get('amount', 0):.2f}\n"
+            f"📅 Date: {escape_md(context.user_data.get('date'))}\n"
+        ]
         
         if context.user_data.get('store'):
-            summary += f"🏪 Store: {context.user_data.get('store')}\n"
+            parts.append(f"🏪 Store: {escape_md(context.user_data.get('store'))}\n")
         
-        summary += f"📊 Category: {category}\n"
+        parts.append(f"📊 Category: {category}\n")
         
         items = context.user_data.get('items', [])
         if items:
-            summary += f"🛒 Items: {len(items)} items detected\n"
+            parts.append(f"🛒 Items: {len(items)} items detected\n")
         
-        summary += "\nEnter description (optional, or type 'skip'):"
+        parts.append("\nEnter description (optional, or type 'skip'):")
         
-        await query.edit_message_text(summary, parse_mode='Markdown')
+        await query.edit_message_text("".join(parts), parse_mode='Markdown')
         return DESCRIPTION
     
     async def handle_description(self, update: Update, context: CallbackContext):
@@ -554,35 +1208,53 @@ Try sending me a receipt photo now! 📸
                 'has_image': context.user_data.get('has_image', False)
             }
             
-            # Save to Google Sheets
-            self.sheet.add_transaction(transaction_data)
+            # Save to Google Sheets. Waiting for this row keeps the confirmation honest;
+            # saves from other chats arriving meanwhile share the same append_rows call.
+            # shield() keeps a timeout here from cancelling the row's future.
+            saved = await self.sheet.add_transaction(transaction_data)
+            error = await asyncio.wait_for(asyncio.shield(saved), FLUSH_TIMEOUT)
+            if error is not None:
+                raise error
             
             # Success message
-            success_msg = f"✅ **Receipt saved successfully!**\n\n"
-            success_msg += f"👤 **Name:** {transaction_data['name']}\n"
-            success_msg += f"💰 **Amount:** ${transaction_data['amount']:.2f}\n"
-            success_msg += f"📅 **Date:** {transaction_data['date']}\n"
-            success_msg += f"📊 **Category:** {transaction_data['category']}\n"
+            parts = [
+                "✅ **Receipt saved successfully!**\n\n"
+                f"👤 **Name:** {escape_md(transaction_data['name'])}\n"
+                f"💰 **Amount:** ${transaction_data['amount']:.2f}\n"
+                f"📅 **Date:** {escape_md(transaction_data['date'])}\n"
+                f"📊 **Category:** {transaction_data['category']}\n"
+            ]
             
             if transaction_data.get('store'):
-                success_msg += f"🏪 **Store:** {transaction_data['store']}\n"
+                parts.append(f"🏪 **Store:** {escape_md(transaction_data['store'])}\n")
             
             if transaction_data.get('description'):
-                success_msg += f"📝 **Description:** {transaction_data['description']}\n"
+                parts.append(f"📝 **Description:** {escape_md(transaction_data['description'])}\n")
             
             if transaction_data['has_image']:
-                success_msg += "📸 **Receipt image:** Processed with AI\n"
+                parts.append("📸 **Receipt image:** Processed with AI\n")
             
             items = transaction_data.get('items', [])
             if items:
-                success_msg += f"🛒 **Items:** {len(items)} items recorded\n"
+                parts.append(f"🛒 **Items:** {len(items)} items recorded\n")
             
-            success_msg += "\nUse /search to view transactions or send another receipt!"
+            parts.append("\nUse /search to view transactions or send another receipt!")
             
-            await update.message.reply_text(success_msg, parse_mode='Markdown')
+            await update.message.reply_text("".join(parts), parse_mode='Markdown')
             
+        except asyncio.TimeoutError:
+            logger.warning("Sheet write still pending after %ss", FLUSH_TIMEOUT)
+            await update.message.reply_text(
+                "⏳ Google Sheets is slow to respond. Your receipt is queued and will be saved shortly."
+            )
+        except SheetWriteUncertain as e:
+            logger.error("Save not confirmed: %s", e)
+            await update.message.reply_text(
+                "⚠️ Google Sheets didn't confirm the save, so it may or may not have gone through. "
+                "Check /search before sending this receipt again."
+            )
         except Exception as e:
-            logger.error(f"Error saving: {e}")
+            logger.error("Error saving: %s", e)
             traceback.print_exc()
             await update.message.reply_text("❌ Error saving receipt to Google Sheets.")
         
@@ -603,80 +1275,121 @@ Try sending me a receipt photo now! 📸
     async def _show_transactions(self, update: Update, name: str):
         """Display transactions for a specific person"""
         try:
-            transactions = self.sheet.get_transactions_by_name(name)
+            transactions = await self.sheet.get_transactions_by_name(name)
             
             if not transactions:
                 await update.message.reply_text(f"No transactions found for {name}")
                 return
             
-            response = f"📊 **Transactions for {name}:**\n\n"
-            total = 0
+            # Rows are grouped into messages under Telegram's 4096-char limit and each
+            # message is sent as soon as it fills, never splitting a transaction
+            # Sheet values are user and model text, so every one is cut to length and then
+            # escaped for Markdown; the lengths counted below are of the escaped text
+            clip = partial(clip_text, limit=SEARCH_FIELD_MAX_LEN)
+            chunk = [f"📊 **Transactions for {escape_md(clip(name))}:**\n\n"]
+            chunk_len = len(chunk[0])
             
             for i, transaction in enumerate(transactions, 1):
-                try:
-                    amount = float(transaction.get('Amount', 0))
-                except (ValueError, TypeError):
-                    amount = 0
-                total += amount
+                amount = transaction.get('Amount', 0)
                 
-                response += (
-                    f"**{i}. Date:** {transaction.get('Date', 'N/A')}\n"
+                parts = [
+                    f"**{i}. Date:** {escape_md(clip(transaction.get('Date', 'N/A')))}\n"
                     f"**Amount:** ${amount:.2f}\n"
-                    f"**Category:** {transaction.get('Category', 'N/A')}\n"
-                )
+                    f"**Category:** {escape_md(clip(transaction.get('Category', 'N/A')))}\n"
+                ]
                 
+                # Free text is capped so one long note can't make a block too big to send
                 store = transaction.get('Store', '')
                 if store:
-                    response += f"**Store:** {store}\n"
+                    parts.append(f"**Store:** {escape_md(clip(store))}\n")
                 
                 items = transaction.get('Items Summary', '')
                 if items:
-                    response += f"**Items:** {items}\n"
+                    parts.append(f"**Items:** {escape_md(clip(items))}\n")
                 
                 desc = transaction.get('Description', '')
                 if desc:
-                    response += f"**Note:** {desc}\n"
+                    parts.append(f"**Note:** {escape_md(clip(desc))}\n")
                 
                 if transaction.get('AI Analysis') == 'Yes':
-                    response += f"**🤖 AI analyzed**\n"
+                    parts.append("**🤖 AI analyzed**\n")
                 
                 if transaction.get('Image Available') == 'Yes':
-                    response += f"**📸 Has receipt image**\n"
+                    parts.append("**📸 Has receipt image**\n")
                 
-                response += f"{'─' * 30}\n"
-            
-            response += f"\n💰 **Total:** ${total:.2f}"
-            response += f"\n📊 **Count:** {len(transactions)} transactions"
+                parts.append(DIVIDER)
+                block = "".join(parts)
+                
+                if chunk and chunk_len + len(block) > MESSAGE_CHUNK_SIZE:
+                    await update.message.reply_text("".join(chunk), parse_mode='Markdown')
+                    chunk, chunk_len = [], 0
+                chunk.append(block)
+                chunk_len += len(block)
             
-            if len(response) > 4000:
-                chunks = [response[i:i+4000] for i in range(0, len(response), 4000)]
-                for chunk in chunks:
-                    await update.message.reply_text(chunk, parse_mode='Markdown')
-            else:
-                await update.message.reply_text(response, parse_mode='Markdown')
+            footer = (
+                f"\n💰 **Total:** ${self.sheet.get_total_by_name(name):.2f}"
+                f"\n📊 **Count:** {len(transactions)} transactions"
+            )
+            if chunk and chunk_len + len(footer) > MESSAGE_CHUNK_SIZE:
+                await update.message.reply_text("".join(chunk), parse_mode='Markdown')
+                chunk = []
+            chunk.append(footer)
+            await update.message.reply_text("".join(chunk), parse_mode='Markdown')
                 
         except Exception as e:
-            logger.error(f"Error fetching: {e}")
+            logger.error("Error fetching: %s", e)
             traceback.print_exc()
             await update.message.reply_text("❌ Error fetching transactions.")
     
     async def list_names(self, update: Update, context: CallbackContext):
         """List all names in the database"""
         try:
-            names = self.sheet.get_all_names()
+            names = await self.sheet.get_all_names()
             if names:
-                response = "📋 **People in records:**\n\n"
-                for i, name in enumerate(sorted(names), 1):
-                    response += f"{i}. {name}\n"
-                response += "\nUse `/search <name>` to see transactions"
+                response, reply_markup = self._names_page(names, 0)
             else:
-                response = "No records found yet."
+                response, reply_markup = "No records found yet.", None
             
-            await update.message.reply_text(response, parse_mode='Markdown')
+            await update.message.reply_text(response, parse_mode='Markdown', reply_markup=reply_markup)
         except Exception as e:
-            logger.error(f"Error listing: {e}")
+            logger.error("Error listing: %s", e)
             await update.message.reply_text("❌ Error accessing database.")
     
+    async def handle_names_page(self, update: Update, context: CallbackContext):
+        """Show another page of the /list output"""
+        query = update.callback_query
+        await query.answer()
+        
+        try:
+            names = await self.sheet.get_all_names()
+            page = int(query.data.rsplit(':', 1)[1])
+            response, reply_markup = self._names_page(names, page)
+            await query.edit_message_text(response, parse_mode='Markdown', reply_markup=reply_markup)
+        except Exception as e:
+            logger.error("Error listing: %s", e)
+            await query.edit_message_text("❌ Error accessing database.")
+    
+    @staticmethod
+    def _names_page(names: List[str], page: int):
+        """Render one page of names with prev/next buttons"""
+        pages = max(1, -(-len(names) // PAGE_SIZE))
+        page = min(page, pages - 1)
+        start = page * PAGE_SIZE
+        
+        parts = [f"📋 **People in records** (page {page + 1}/{pages}):\n\n"]
+        parts.extend(
+            f"{i}. {escape_md(name)}\n" for i, name in enumerate(names[start:start + PAGE_SIZE], start + 1)
+        )
+        parts.append("\nUse `/search <name>` to see transactions")
+        
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️", callback_data=f"names:page:{page - 1}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("▶️", callback_data=f"names:page:{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        return "".join(parts), reply_markup
+    
     async def cancel(self, update: Update, context: CallbackContext):
         """Cancel the conversation"""
         context.user_data.clear()
@@ -685,36 +1398,7 @@ Try sending me a receipt photo now! 📸
     
     async def help_command(self, update: Update, context: CallbackContext):
         """Show help message"""
-        help_text = """
-🤖 **AI Receipt Scanner Bot Help**
-
-**Main Features:**
-📸 Send any receipt photo - AI analyzes it automatically!
-🤖 GPT-4 Vision extracts details with high accuracy
-📊 Saves to Google Sheets with rich data
-
-**Commands:**
-/start - Welcome message
-/add - Add transaction manually
-/search <name> - Find transactions by name
-/list - List all people
-/help - This message
-
-**How it works:**
-1. Send a receipt photo
-2. AI analyzes and extracts details
-3. Review AI findings
-4. Confirm to save
-5. Add person's name
-6. Select category
-7. Add description
-8. ✅ Saved to Google Sheets!
-
-**Example:**
-/search John Doe
-Shows all John's receipts
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
 def main():
     """Start the bot"""
@@ -742,11 +1426,47 @@ def main():
         traceback.print_exc()
         return
     
+    if os.getenv('RUN_DIAGNOSTICS'):
+        diagnose(sheet_manager)
+    
     # Create bot
     bot = ReceiptBot(sheet_manager)
     
+    async def flush_pending(application: Application) -> None:
+        """Write any buffered rows before the process exits"""
+        try:
+            await asyncio.wait_for(sheet_manager.flush(), FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Timed out writing queued rows to Google Sheets")
+        except SheetWriteError as e:
+            logger.error("Some queued rows were not saved: %s", e)
+    
+    async def close_clients(application: Application) -> None:
+        """Close long-lived HTTP connections on shutdown"""
+        await bot.ai_vision.close()
+    
     # Create application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Paces outgoing messages under Telegram's global and per-group limits
+        # and retries on RetryAfter, so bursts don't end in 429 errors
+        .rate_limiter(AIORateLimiter(max_retries=TELEGRAM_MAX_RETRIES))
+        .post_stop(flush_pending)
+        .post_shutdown(close_clients)
+        .build()
+    )
+    
+    # Steps shared by the photo and manual flows, built once and used by both
+    text_input = filters.TEXT & ~filters.COMMAND
+    cancel_handler = CommandHandler('cancel', bot.cancel)
+    common_states = {
+        NAME: [MessageHandler(text_input, bot.handle_name), cancel_handler],
+        AMOUNT: [MessageHandler(text_input, bot.handle_amount), cancel_handler],
+        DATE: [MessageHandler(text_input, bot.handle_date), cancel_handler],
+        CATEGORY: [CallbackQueryHandler(bot.handle_category), cancel_handler],
+        DESCRIPTION: [MessageHandler(text_input, bot.handle_description), cancel_handler]
+    }
     
     # Conversation handler for photo analysis (FIXED: removed per_message=True)
     photo_handler = ConversationHandler(
@@ -756,30 +1476,11 @@ def main():
         states={
             CONFIRM_DETAILS: [
                 CallbackQueryHandler(bot.handle_confirmation),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            NAME: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_name),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            AMOUNT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_amount),
-                CommandHandler('cancel', bot.cancel)
+                cancel_handler
             ],
-            DATE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_date),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            CATEGORY: [
-                CallbackQueryHandler(bot.handle_category),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            DESCRIPTION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_description),
-                CommandHandler('cancel', bot.cancel)
-            ]
+            **common_states
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        fallbacks=[cancel_handler],
         allow_reentry=True
     )
     
@@ -788,45 +1489,27 @@ def main():
         entry_points=[
             CommandHandler('add', bot.add_receipt)
         ],
-        states={
-            NAME: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_name),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            AMOUNT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_amount),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            DATE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_date),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            CATEGORY: [
-                CallbackQueryHandler(bot.handle_category),
-                CommandHandler('cancel', bot.cancel)
-            ],
-            DESCRIPTION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_description),
-                CommandHandler('cancel', bot.cancel)
-            ]
-        },
-        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        states=common_states,
+        fallbacks=[cancel_handler],
         allow_reentry=True
     )
     
     # Add handlers
-    application.add_handler(CommandHandler('start', bot.start))
+    # Stateless commands run concurrently so /help isn't stuck behind a slow /search
+    application.add_handler(CommandHandler('start', bot.start, block=False))
+    # Ahead of the conversations, whose category step accepts any callback query
+    application.add_handler(CallbackQueryHandler(bot.handle_names_page, pattern=NAMES_PAGE_RE))
     application.add_handler(photo_handler)
     application.add_handler(manual_handler)
-    application.add_handler(CommandHandler('search', bot.search_transactions))
-    application.add_handler(CommandHandler('list', bot.list_names))
-    application.add_handler(CommandHandler('help', bot.help_command))
+    application.add_handler(CommandHandler('search', bot.search_transactions, block=False))
+    application.add_handler(CommandHandler('list', bot.list_names, block=False))
+    application.add_handler(CommandHandler('help', bot.help_command, block=False))
     application.add_handler(CommandHandler('cancel', bot.cancel))
     
     # Error handler
     async def error_handler(update: object, context: CallbackContext) -> None:
         """Log errors."""
-        logger.error(f"Exception while handling update: {update}", exc_info=context.error)
+        logger.error("Exception while handling update: %s", update, exc_info=context.error)
         if context.error:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id if update and update.effective_chat else None,
@@ -835,41 +1518,36 @@ def main():
     
     application.add_error_handler(error_handler)
     
-    # Start bot with webhook for Render
+    # Start bot
     print("🤖 Bot is running...")
     print("📱 Send /start to your bot on Telegram")
     print("📸 Try sending a receipt photo for AI analysis!")
     
-    # Check if running on Render
-    IS_RENDER = os.getenv('RENDER', '').lower() == 'true'
+    # Webhooks let Telegram push updates instead of the bot long-polling getUpdates.
+    # BOT_MODE=webhook|polling picks explicitly; by default a webhook is used
+    # whenever WEBHOOK_URL is set.
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    BOT_MODE = os.getenv('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling').lower()
     
-    if IS_RENDER:
-        print("🌐 Running on Render with webhook...")
+    if BOT_MODE == 'webhook' and WEBHOOK_URL:
         PORT = int(os.getenv('PORT', 10000))
-        WEBHOOK_URL = os.getenv('WEBHOOK_URL')
-        
-        if WEBHOOK_URL:
-            print(f"🌐 Webhook URL: {WEBHOOK_URL}")
-            # Set webhook
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=TELEGRAM_TOKEN,
-                webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
-                drop_pending_updates=True
-            )
-        else:
-            print("⚠️  WEBHOOK_URL not set, using polling")
-            application.run_polling(
-                drop_pending_updates=True,
-                allowed_updates=Update.ALL_TYPES
-            )
+        print(f"🌐 Running with webhook: {WEBHOOK_URL}")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES
+        )
     else:
-        # Local development
-        print("🏠 Running locally with polling...")
+        if BOT_MODE == 'webhook':
+            print("⚠️  WEBHOOK_URL not set, using polling")
+        else:
+            print("🏠 Running with polling...")
         application.run_polling(
             drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
+            allowed_updates=ALLOWED_UPDATES
         )
 
 if __name__ == '__main__':